@@ -1,21 +1,155 @@
 import streamlit as st
 import os
+import sys
+import multiprocessing
+import json
+import hashlib
 import zipfile
 import tempfile
 import shutil
 from pathlib import Path
-import time
+import nest_asyncio
+from collections import OrderedDict
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import parsers
 
 # Imports do LlamaIndex
-from llama_index.core import SimpleDirectoryReader, VectorStoreIndex, Settings, Document
+from llama_index.core import (
+    SimpleDirectoryReader, VectorStoreIndex, Settings, StorageContext, load_index_from_storage
+)
 from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.prompts.default_prompt_selectors import DEFAULT_TREE_SUMMARIZE_PROMPT_SEL
 from llama_index.llms.openai import OpenAI
 
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+CACHE_DIR = ".cache"
+ONNX_MODEL_DIR = os.path.join(CACHE_DIR, "onnx-all-MiniLM-L6-v2")
+CHUNK_SIZE = 1024
+CHUNK_OVERLAP = 128
+# Índices salvos guardam o texto completo dos documentos (docstore.json):
+# só os mais recentes ficam em disco
+MAX_INDICES_SALVOS = 10
+FORMATOS_SUPORTADOS = frozenset({'.pdf', '.docx', '.pptx', '.txt', '.md'})
+
+class SmartBatchMixin:
+    """Smart batching: agrupa textos de tamanho parecido para que cada
+    lote seja preenchido (padding) só até o maior do lote"""
+
+    def _tokenizer_para_ordenar(self):
+        tokenizer = getattr(self, "_tokenizer", None)
+        if tokenizer is None:
+            tokenizer = getattr(getattr(self, "_model", None), "tokenizer", None)
+        return tokenizer
+
+    def get_text_embedding_batch(self, texts, show_progress=False, **kwargs):
+        tokenizer = self._tokenizer_para_ordenar()
+        if tokenizer is not None:
+            tamanhos = [len(tokenizer.tokenize(t)) for t in texts]
+        else:
+            tamanhos = [len(t) for t in texts]
+        ordem = sorted(range(len(texts)), key=tamanhos.__getitem__, reverse=True)
+
+        embeddings_ordenados = super().get_text_embedding_batch(
+            [texts[i] for i in ordem], show_progress=show_progress, **kwargs
+        )
+
+        # Desfazer a ordenação para devolver na ordem original
+        embeddings = [None] * len(texts)
+        for posicao, i in enumerate(ordem):
+            embeddings[i] = embeddings_ordenados[posicao]
+        return embeddings
+
+# Import condicional do PyTorch para detectar GPU
+try:
+    import torch
+    torch.set_float32_matmul_precision("high")
+except ImportError:
+    torch = None
+
 # Import condicional para embeddings
 try:
     from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+
+    class SmartBatchEmbedding(SmartBatchMixin, HuggingFaceEmbedding):
+        """Embeddings HuggingFace (PyTorch) com smart batching"""
 except ImportError:
     HuggingFaceEmbedding = None
+    SmartBatchEmbedding = None
+
+# Import condicional para embeddings quantizados (ONNX Runtime int8)
+try:
+    import onnxruntime
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    class OnnxEmbedding(SmartBatchMixin, BaseEmbedding):
+        """Embeddings do MiniLM quantizado em int8 servido pelo ONNX Runtime"""
+
+        _model = PrivateAttr()
+        _tokenizer = PrivateAttr()
+
+        def __init__(self, pasta_modelo, **kwargs):
+            super().__init__(**kwargs)
+            opcoes = onnxruntime.SessionOptions()
+            opcoes.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            self._model = ORTModelForFeatureExtraction.from_pretrained(
+                pasta_modelo,
+                file_name="model_quantized.onnx",
+                provider="CPUExecutionProvider",
+                session_options=opcoes
+            )
+            self._tokenizer = AutoTokenizer.from_pretrained(pasta_modelo)
+
+        def _embed(self, textos):
+            tokens = self._tokenizer(
+                textos, padding=True, truncation=True, max_length=256, return_tensors="np"
+            )
+            saida = self._model(**tokens).last_hidden_state
+
+            # Mean pooling pela attention mask + normalização (como no sentence-transformers)
+            mascara = tokens["attention_mask"][..., None].astype(saida.dtype)
+            media = (saida * mascara).sum(axis=1) / np.clip(mascara.sum(axis=1), 1e-9, None)
+            media /= np.linalg.norm(media, axis=1, keepdims=True)
+            return media.tolist()
+
+        def _get_query_embedding(self, query):
+            return self._embed([query])[0]
+
+        async def _aget_query_embedding(self, query):
+            return self._get_query_embedding(query)
+
+        def _get_text_embedding(self, text):
+            return self._embed([text])[0]
+
+        def _get_text_embeddings(self, texts):
+            return self._embed(texts)
+except ImportError:
+    OnnxEmbedding = None
+
+# Import condicional para o vector store HNSW (FAISS)
+try:
+    import faiss
+    from llama_index.vector_stores.faiss import FaissVectorStore
+
+    class FaissQuantizadoVectorStore(FaissVectorStore):
+        """FaissVectorStore que treina o quantizador no primeiro lote de embeddings"""
+
+        def add(self, nodes, **add_kwargs):
+            if nodes and not self._faiss_index.is_trained:
+                vetores = np.stack([np.asarray(n.get_embedding(), dtype="float32") for n in nodes])
+                self._faiss_index.train(vetores)
+            return super().add(nodes, **add_kwargs)
+except ImportError:
+    faiss = None
+
+# Permitir reentrada no event loop (resumos assíncronos do tree_summarize)
+nest_asyncio.apply()
 
 # Configuração da página
 st.set_page_config(
@@ -81,154 +215,355 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-def processar_pptx(caminho_arquivo):
-    """Processa arquivo PowerPoint extraindo texto de todos os slides"""
-    try:
-        from pptx import Presentation
+def _metadata_documento(caminho):
+    """Metadata dos documentos lidos pelo SimpleDirectoryReader"""
+    return {
+        "file_name": os.path.basename(caminho),
+        "file_type": Path(caminho).suffix[1:].lower(),
+        "source": "document"
+    }
+
+def extrair_membros(zip_ref, membros, pasta_destino):
+    """Extrai os membros do ZIP em blocos de 1 MiB, sem carregar cada arquivo inteiro na memória"""
+    caminhos = []
+    for n, info in enumerate(membros):
+        # Uma subpasta por membro: preserva o nome original sem colisões nem path traversal
+        pasta = os.path.join(pasta_destino, str(n))
+        os.mkdir(pasta)
+        caminho = os.path.join(pasta, os.path.basename(info.filename))
+        with zip_ref.open(info) as origem, open(caminho, "wb") as destino:
+            shutil.copyfileobj(origem, destino, length=1 << 20)
+        caminhos.append(caminho)
+    return caminhos
+
+def processar_documentos(zip_path):
+    """Processa todos os documentos suportados dentro do ZIP"""
+    
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref, tempfile.TemporaryDirectory() as pasta_temp:
+        # Encontrar e separar os arquivos suportados numa única passada (ignorando metadados do macOS)
+        membros_pool, outros_membros = [], []
+        for info in zip_ref.infolist():
+            if info.is_dir() or info.filename.startswith("__MACOSX/"):
+                continue
+            
+            extensao = os.path.splitext(info.filename)[1].lower()
+            if extensao == ".pptx" or (extensao == ".pdf" and parsers.fitz is not None):
+                membros_pool.append(info)
+            elif extensao in FORMATOS_SUPORTADOS:
+                outros_membros.append(info)
+        
+        membros = membros_pool + outros_membros
+        if not membros:
+            return [], 0
         
-        prs = Presentation(caminho_arquivo)
-        slides_texto = []
+        documentos_processados = []
+        progress_bar = st.progress(0)
+        status_text = st.empty()
+        concluidos = 0
         
-        for i, slide in enumerate(prs.slides, 1):
-            slide_content = f"\n=== SLIDE {i} ===\n"
+        # Parsing é CPU-bound: distribuir PPTX e PDFs entre processos (evita o GIL).
+        # Cada worker lê o próprio membro do ZIP: o processo principal não guarda os bytes.
+        # Com "fork" (Linux) os workers não reexecutam o app.py, que o Streamlit instala
+        # como __main__; os parsers vivem no módulo parsers, importável por nome
+        contexto = multiprocessing.get_context("fork") if sys.platform == "linux" else None
+        with ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, 6), mp_context=contexto) as executor:
+            futuros = {
+                executor.submit(parsers.processar_membro, zip_path, info.filename): os.path.basename(info.filename)
+                for info in membros_pool
+            }
             
-            # Extrair texto de todas as formas no slide
-            for shape in slide.shapes:
-                if hasattr(shape, "text") and shape.text.strip():
-                    slide_content += f"{shape.text}\n"
+            # Demais formatos: um único loader, lido arquivo a arquivo enquanto o pool trabalha
+            # (sem num_workers: processos "spawn" reimportariam o app inteiro)
+            if outros_membros:
+                caminhos = extrair_membros(zip_ref, outros_membros, pasta_temp)
                 
-                # Extrair texto de tabelas se houver
-                if shape.has_table:
-                    table = shape.table
-                    for row in table.rows:
-                        row_text = " | ".join([cell.text.strip() for cell in row.cells])
-                        if row_text.strip():
-                            slide_content += f"Tabela: {row_text}\n"
+                loader = SimpleDirectoryReader(
+                    input_files=caminhos,
+                    file_metadata=_metadata_documento
+                )
+                
+                # Um arquivo por vez, reaproveitando os leitores do loader: um arquivo
+                # com erro gera aviso próprio sem interromper os demais
+                for caminho in loader.input_files:
+                    arquivo = os.path.basename(caminho)
+                    try:
+                        docs = SimpleDirectoryReader.load_file(
+                            caminho,
+                            _metadata_documento,
+                            loader.file_extractor,
+                            raise_on_error=True
+                        )
+                        documentos_processados.extend(docs)
+                    except Exception as e:
+                        # load_file embrulha o erro original em "Error loading file"
+                        st.warning(f"Erro ao processar {arquivo}: {e.__cause__ or e}")
+                    
+                    concluidos += 1
+                    status_text.text(f"Processado: {arquivo}")
+                    progress_bar.progress(concluidos / len(membros))
             
-            slides_texto.append(slide_content)
-        
-        texto_completo = "\n".join(slides_texto)
-        
-        return Document(
-            text=texto_completo,
-            metadata={
-                "file_name": os.path.basename(caminho_arquivo),
-                "file_type": "pptx",
-                "total_slides": len(prs.slides),
-                "source": "presentation"
-            }
-        ), len(prs.slides)
-        
-    except Exception as e:
-        st.error(f"Erro ao processar PPTX {os.path.basename(caminho_arquivo)}: {e}")
-        return None, 0
-
-def processar_documentos(pasta_temp):
-    """Processa todos os documentos suportados na pasta temporária"""
-    
-    formatos_suportados = ['.pdf', '.docx', '.pptx', '.txt', '.md']
-    arquivos = []
-    
-    # Encontrar todos os arquivos suportados
-    for arquivo in os.listdir(pasta_temp):
-        extensao = Path(arquivo).suffix.lower()
-        if extensao in formatos_suportados:
-            arquivos.append(arquivo)
+            for futuro in as_completed(futuros):
+                arquivo = futuros[futuro]
+                concluidos += 1
+                status_text.text(f"Processado: {arquivo}")
+                progress_bar.progress(concluidos / len(membros))
+                
+                try:
+                    docs, _ = futuro.result()
+                    documentos_processados.extend(docs)
+                except Exception as e:
+                    st.warning(f"Erro ao processar {arquivo}: {e}")
     
-    if not arquivos:
-        return [], 0
+    # Limpar a barra imediatamente (sem pausa cosmética)
+    progress_bar.empty()
+    status_text.empty()
     
-    documentos_processados = []
-    progress_bar = st.progress(0)
-    status_text = st.empty()
+    return documentos_processados, len(membros)
+
+def exportar_modelo_onnx(pasta_modelo):
+    """Exporta o modelo de embeddings para ONNX quantizado em int8 (apenas na primeira vez)"""
+    arquivos_finais = ("model_quantized.onnx", "tokenizer_config.json")
+    if all(os.path.exists(os.path.join(pasta_modelo, nome)) for nome in arquivos_finais):
+        return
     
-    for i, arquivo in enumerate(arquivos):
-        caminho = os.path.join(pasta_temp, arquivo)
-        extensao = Path(arquivo).suffix.lower()
-        
-        status_text.text(f"Processando: {arquivo}")
-        progress_bar.progress((i + 1) / len(arquivos))
+    # Exportar numa pasta temporária e movê-la só no fim: uma exportação
+    # interrompida nunca deixa uma pasta incompleta no lugar da definitiva
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    pasta_temp = tempfile.mkdtemp(dir=CACHE_DIR, prefix="onnx-export-")
+    try:
+        modelo = ORTModelForFeatureExtraction.from_pretrained(EMBED_MODEL_NAME, export=True)
+        quantizer = ORTQuantizer.from_pretrained(modelo)
+        quantizer.quantize(
+            save_dir=pasta_temp,
+            quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+        )
+        AutoTokenizer.from_pretrained(EMBED_MODEL_NAME).save_pretrained(pasta_temp)
         
+        # Remover restos de uma exportação incompleta antes de substituir
+        shutil.rmtree(pasta_modelo, ignore_errors=True)
+        os.replace(pasta_temp, pasta_modelo)
+    finally:
+        shutil.rmtree(pasta_temp, ignore_errors=True)
+
+@st.cache_resource
+def get_embed_model():
+    """Carrega o modelo de embeddings uma única vez por processo"""
+    # Com GPU disponível, o modelo HuggingFace em CUDA com lotes grandes é o mais rápido
+    if SmartBatchEmbedding and torch is not None and torch.cuda.is_available():
+        return SmartBatchEmbedding(
+            model_name=EMBED_MODEL_NAME,
+            device="cuda",
+            embed_batch_size=256
+        )
+    
+    # Em CPU, preferir o modelo int8 no ONNX Runtime; se falhar, usar o HuggingFace
+    if OnnxEmbedding:
         try:
-            if extensao == ".pptx":
-                # Processamento específico para PowerPoint
-                doc, num_slides = processar_pptx(caminho)
-                if doc:
-                    documentos_processados.append(doc)
-                    
-            elif extensao in [".docx", ".pdf", ".txt", ".md"]:
-                # Usar loader padrão para outros formatos
-                loader = SimpleDirectoryReader(
-                    input_files=[caminho],
-                    required_exts=[extensao]
-                )
-                docs = loader.load_data()
-                
-                # Adicionar metadata específico
-                for doc in docs:
-                    doc.metadata.update({
-                        "file_name": arquivo,
-                        "file_type": extensao[1:],
-                        "source": "document"
-                    })
-                
-                documentos_processados.extend(docs)
-                
+            exportar_modelo_onnx(ONNX_MODEL_DIR)
+            return OnnxEmbedding(
+                ONNX_MODEL_DIR,
+                model_name=EMBED_MODEL_NAME,
+                embed_batch_size=64
+            )
         except Exception as e:
-            st.warning(f"Erro ao processar {arquivo}: {e}")
+            st.warning(f"Embeddings ONNX indisponíveis, usando HuggingFace: {e}")
     
-    progress_bar.progress(1.0)
-    status_text.text("Processamento concluído!")
-    time.sleep(1)
-    progress_bar.empty()
-    status_text.empty()
+    if SmartBatchEmbedding:
+        return SmartBatchEmbedding(
+            model_name=EMBED_MODEL_NAME,
+            device="cpu",
+            embed_batch_size=64
+        )
     
-    return documentos_processados, len(arquivos)
+    return None
+
+@st.cache_resource
+def get_llm(api_key):
+    """Instancia o LLM uma única vez por API Key"""
+    return OpenAI(model="gpt-3.5-turbo", temperature=0.5, api_key=api_key)
 
 def configurar_sistema():
     """Configura o sistema RAG com os modelos"""
     try:
-        # Configurar embeddings se disponível
-        if HuggingFaceEmbedding:
-            embed_model = HuggingFaceEmbedding(model_name="sentence-transformers/all-MiniLM-L6-v2")
+        # Configurar embeddings se disponível (modelo reaproveitado entre reruns)
+        embed_model = get_embed_model()
+        if embed_model:
             Settings.embed_model = embed_model
         
-        Settings.llm = OpenAI(model="gpt-3.5-turbo", temperature=0.5)
+        Settings.llm = get_llm(os.environ["OPENAI_API_KEY"])
         return True
     except Exception as e:
         st.error(f"Erro na configuração: {e}")
         return False
 
-def criar_indice(documentos):
-    """Cria o índice vetorial dos documentos"""
+def criar_storage_context():
+    """Cria o storage com índice HNSW (FAISS) quantizado em int8 para busca sub-linear dos vizinhos"""
+    if faiss is None:
+        # Sem FAISS: LlamaIndex usa o SimpleVectorStore (busca linear)
+        return None
+    
+    # Dimensão do modelo ativo (MiniLM local: 384; fallback OpenAI: 1536)
+    dimensao = len(Settings.embed_model.get_text_embedding("x"))
+    
+    # Vetores armazenados com scalar quantization de 8 bits (4x menos memória)
+    faiss_index = faiss.IndexHNSWSQ(dimensao, faiss.ScalarQuantizer.QT_8bit, 32)
+    faiss_index.hnsw.efConstruction = 200
+    faiss_index.hnsw.efSearch = 64
+    
+    return StorageContext.from_defaults(
+        vector_store=FaissQuantizadoVectorStore(faiss_index=faiss_index)
+    )
+
+def criar_query_engine(index):
+    """Cria o query engine sobre o índice vetorial"""
+    query_engine = index.as_query_engine(
+        similarity_top_k=40,             # Mais documentos consultados
+        response_mode="tree_summarize",         # Mantém o modo
+        use_async=True,                          # Resumos intermediários em paralelo
+        verbose=True,
+        streaming=True,                          # Resposta exibida conforme é gerada
+        max_tokens=12000,                        # Limite maior de resposta
+        temperature=0.5
+    )
+    
+    # Resolver o seletor de prompt para o LLM configurado uma única vez,
+    # em vez de a cada pergunta
+    query_engine.update_prompts({
+        "response_synthesizer:summary_template": DEFAULT_TREE_SUMMARIZE_PROMPT_SEL.select(Settings.llm)
+    })
+    
+    return query_engine
+
+def assinatura_indice():
+    """Resume a configuração que determina o conteúdo de um índice salvo"""
+    embed_model = Settings.embed_model
+    configuracao = "|".join([
+        EMBED_MODEL_NAME,
+        type(embed_model).__name__,
+        str(getattr(embed_model, "_device", "cpu")),
+        f"{CHUNK_SIZE}/{CHUNK_OVERLAP}",
+        "faiss-hnsw-sq8" if faiss is not None else "simple"
+    ])
+    return hashlib.blake2b(configuracao.encode(), digest_size=8).hexdigest()
+
+def limpar_indices_antigos():
+    """Remove os índices salvos menos usados além do limite MAX_INDICES_SALVOS"""
+    pastas = [
+        entrada.path for entrada in os.scandir(CACHE_DIR)
+        if entrada.is_dir() and entrada.name.startswith("indice-")
+    ]
+    pastas.sort(key=os.path.getmtime, reverse=True)
+    for pasta in pastas[MAX_INDICES_SALVOS:]:
+        shutil.rmtree(pasta, ignore_errors=True)
+
+def criar_indice(documentos, persist_dir=None, num_arquivos=0):
+    """Cria o índice vetorial dos documentos e o salva em disco"""
     try:
         with st.spinner("Criando índice vetorial..."):
             node_parser = SentenceSplitter(
-                chunk_size=3000, 
-                chunk_overlap=600,
+                chunk_size=CHUNK_SIZE, 
+                chunk_overlap=CHUNK_OVERLAP,
                 paragraph_separator="\n\n"
             )
             
-            index = VectorStoreIndex.from_documents(
-                documentos, 
-                node_parser=node_parser
-            )
+            # Quebrar em nós antes de indexar (serial: processos "spawn" reimportariam o app)
+            nodes = node_parser.get_nodes_from_documents(documentos)
             
-
-            query_engine = index.as_query_engine(
-                similarity_top_k=40,             # Mais documentos consultados
-                response_mode="tree_summarize",         # Mantém o modo
-                verbose=True,
-                streaming=False,
-                max_tokens=12000,                        # Limite maior de resposta
-                temperature=0.5
+            index = VectorStoreIndex(
+                nodes=nodes,
+                storage_context=criar_storage_context(),
+                show_progress=True
             )
             
-            return query_engine
+            # Persistir docstore + vector store (o FAISS é gravado com write_index)
+            if persist_dir:
+                index.storage_context.persist(persist_dir=persist_dir)
+                
+                # Gravado por último: marca o índice como completo
+                with open(os.path.join(persist_dir, "app_meta.json"), "w") as f:
+                    json.dump({"num_arquivos": num_arquivos}, f)
+                
+                limpar_indices_antigos()
+            
+            return criar_query_engine(index)
     except Exception as e:
         st.error(f"Erro ao criar índice: {e}")
         return None
 
+def carregar_indice(persist_dir):
+    """Carrega um índice salvo anteriormente, retornando o query engine e o nº de documentos"""
+    try:
+        if faiss is not None:
+            storage_context = StorageContext.from_defaults(
+                vector_store=FaissVectorStore.from_persist_dir(persist_dir),
+                persist_dir=persist_dir
+            )
+        else:
+            storage_context = StorageContext.from_defaults(persist_dir=persist_dir)
+        
+        index = load_index_from_storage(storage_context)
+        
+        with open(os.path.join(persist_dir, "app_meta.json")) as f:
+            num_arquivos = json.load(f)["num_arquivos"]
+        
+        # Atualizar o mtime: a limpeza remove primeiro os índices menos usados
+        os.utime(persist_dir)
+        
+        return criar_query_engine(index), num_arquivos
+    except Exception as e:
+        st.warning(f"Erro ao carregar índice salvo, recriando: {e}")
+        return None, 0
+
+def aquecer_sistema(query_engine, zip_hash):
+    """Pré-carrega modelo de embeddings e índice para evitar latência na primeira pergunta"""
+    # Um aquecimento por índice: a chave muda a cada novo ZIP carregado
+    if st.session_state.get("warmed") == zip_hash:
+        return
+    
+    try:
+        Settings.embed_model.get_text_embedding("warmup")
+        # Só a recuperação: a síntese completa faria uma chamada paga ao LLM
+        query_engine.retriever.retrieve("warmup")
+        st.session_state.warmed = zip_hash
+    except Exception as e:
+        st.warning(f"Erro ao pré-carregar o sistema: {e}")
+
+def consultar(pergunta, max_itens=512, similaridade_minima=0.97):
+    """Consulta o query engine reaproveitando respostas de perguntas iguais ou quase iguais (retorna os trechos da resposta)"""
+    cache = st.session_state.query_cache
+    chave = " ".join(pergunta.strip().lower().split())
+    
+    # Acerto exato pela pergunta normalizada
+    if chave in cache:
+        cache.move_to_end(chave)
+        return [cache[chave][1]]
+    
+    # Acerto semântico: similaridade de cosseno com as perguntas anteriores
+    embedding = np.asarray(Settings.embed_model.get_query_embedding(chave), dtype=np.float32)
+    embedding /= np.linalg.norm(embedding) or 1.0
+    if cache:
+        chaves = list(cache)
+        similaridades = np.stack([cache[c][0] for c in chaves]) @ embedding
+        melhor = int(np.argmax(similaridades))
+        if similaridades[melhor] > similaridade_minima:
+            cache.move_to_end(chaves[melhor])
+            return [cache[chaves[melhor]][1]]
+    
+    response = st.session_state.query_engine.query(pergunta)
+    
+    def gerar_trechos():
+        trechos = []
+        for trecho in response.response_gen:
+            trechos.append(trecho)
+            yield trecho
+        
+        # Só entra no cache depois que a resposta foi recebida por completo
+        cache[chave] = (embedding, "".join(trechos))
+        if len(cache) > max_itens:
+            cache.popitem(last=False)
+    
+    return gerar_trechos()
+
 def modal_api_key():
     """Modal para inserir API Key"""
     if 'api_key_configured' not in st.session_state:
@@ -285,6 +620,9 @@ def main():
         st.session_state.documentos_processados = False
         st.session_state.query_engine = None
         st.session_state.num_documentos = 0
+        st.session_state.zip_id = None
+        st.session_state.warmed = None
+        st.session_state.query_cache = OrderedDict()
     
     # Seção de upload
     if not st.session_state.documentos_processados:
@@ -303,38 +641,37 @@ def main():
         )
         
         if uploaded_file is not None:
-            with st.spinner("Extraindo e processando documentos..."):
-                # Criar pasta temporária
-                with tempfile.TemporaryDirectory() as temp_dir:
-                    # Salvar e extrair ZIP
-                    zip_path = os.path.join(temp_dir, "upload.zip")
-                    with open(zip_path, "wb") as f:
-                        f.write(uploaded_file.getbuffer())
-                    
-                    # Extrair ZIP
-                    extract_dir = os.path.join(temp_dir, "extracted")
-                    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                        zip_ref.extractall(extract_dir)
-                    
-                    # Processar documentos
-                    documentos, num_arquivos = processar_documentos(extract_dir)
+            # Uma única leitura do buffer: serve para o hash (chave do cache e ID) e para gravar o ZIP
+            zip_buffer = uploaded_file.getbuffer()
+            zip_hash = hashlib.blake2b(zip_buffer, digest_size=16).hexdigest()
+            # A chave inclui a configuração (modelo, backend, chunking, vector store)
+            persist_dir = os.path.join(CACHE_DIR, f"indice-{zip_hash}-{assinatura_indice()}")
+            
+            query_engine, num_documentos = None, 0
+            if os.path.exists(os.path.join(persist_dir, "app_meta.json")):
+                with st.spinner("Carregando índice salvo..."):
+                    query_engine, num_documentos = carregar_indice(persist_dir)
+                    if query_engine:
+                        aquecer_sistema(query_engine, zip_hash)
+            
+            if query_engine is None:
+                with st.spinner("Extraindo e processando documentos..."):
+                    # Criar pasta temporária
+                    with tempfile.TemporaryDirectory() as temp_dir:
+                        # Salvar ZIP
+                        zip_path = os.path.join(temp_dir, "upload.zip")
+                        Path(zip_path).write_bytes(zip_buffer)
+                        
+                        # Processar documentos direto do ZIP
+                        documentos, num_arquivos = processar_documentos(zip_path)
                     
                     if documentos:
-                        # Criar índice
-                        query_engine = criar_indice(documentos)
+                        # Criar e persistir índice
+                        query_engine = criar_indice(documentos, persist_dir, num_arquivos)
+                        num_documentos = num_arquivos
                         
                         if query_engine:
-                            st.session_state.documentos_processados = True
-                            st.session_state.query_engine = query_engine
-                            st.session_state.num_documentos = len(documentos)
-                            
-                            st.markdown(f"""
-                            <div class="success-message">
-                                ✅ <strong>{len(documentos)} documentos processados com sucesso!</strong>
-                            </div>
-                            """, unsafe_allow_html=True)
-                            
-                            st.rerun()
+                            aquecer_sistema(query_engine, zip_hash)
                         else:
                             st.markdown("""
                             <div class="error-message">
@@ -347,12 +684,27 @@ def main():
                             ❌ Nenhum documento válido encontrado no ZIP
                         </div>
                         """, unsafe_allow_html=True)
+            
+            if query_engine:
+                st.session_state.documentos_processados = True
+                st.session_state.query_engine = query_engine
+                st.session_state.num_documentos = num_documentos
+                st.session_state.zip_id = zip_hash[:8]
+                st.session_state.query_cache = OrderedDict()
+                
+                st.markdown(f"""
+                <div class="success-message">
+                    ✅ <strong>{num_documentos} documentos processados com sucesso!</strong>
+                </div>
+                """, unsafe_allow_html=True)
+                
+                st.rerun()
     
     # Seção de chat
     else:
         st.markdown(f"""
         <div class="success-message">
-            ✅ <strong>{st.session_state.num_documentos} documentos carregados</strong> - Sistema pronto para perguntas!
+            ✅ <strong>{st.session_state.num_documentos} documentos carregados</strong> (ZIP {st.session_state.zip_id}) - Sistema pronto para perguntas!
         </div>
         """, unsafe_allow_html=True)
         
@@ -361,6 +713,9 @@ def main():
             st.session_state.documentos_processados = False
             st.session_state.query_engine = None
             st.session_state.num_documentos = 0
+            st.session_state.zip_id = None
+            st.session_state.warmed = None
+            st.session_state.query_cache = OrderedDict()
             st.rerun()
         
         st.markdown("---")
@@ -389,17 +744,23 @@ def main():
         
         # Processar pergunta
         if enviar and pergunta.strip():
-            with st.spinner("Analisando documentos..."):
-                try:
-                    response = st.session_state.query_engine.query(pergunta)
-                    
-                    st.session_state.chat_history.append({
-                        "pergunta": pergunta,
-                        "resposta": response.response
-                    })
-                    
-                except Exception as e:
-                    st.error(f"Erro ao processar pergunta: {e}")
+            try:
+                with st.spinner("Analisando documentos..."):
+                    trechos = consultar(pergunta)
+                
+                # Exibir a resposta à medida que os tokens chegam
+                resposta = st.write_stream(trechos)
+                
+                st.session_state.chat_history.append({
+                    "pergunta": pergunta,
+                    "resposta": resposta
+                })
+                
+            except Exception as e:
+                st.error(f"Erro ao processar pergunta: {e}")
+            else:
+                # Recarregar para a resposta aparecer só no histórico
+                st.rerun()
         
         # Exibir histórico de chat
         if st.session_state.chat_history:
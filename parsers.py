@@ -0,0 +1,94 @@
+"""Parsers executados nos processos do pool de processamento de documentos.
+
+Módulo separado do app.py, sem Streamlit nem torch: os workers o importam
+por nome, sem reexecutar o script do Streamlit.
+"""
+import os
+import io
+import zipfile
+
+from llama_index.core import Document
+
+# Import condicional do PyMuPDF para leitura rápida de PDFs
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
+def processar_pptx(arquivo, nome_arquivo):
+    """Processa arquivo PowerPoint (caminho ou file-like) gerando um Document por slide"""
+    from pptx import Presentation
+    
+    prs = Presentation(arquivo)
+    documentos = []
+    
+    for i, slide in enumerate(prs.slides, 1):
+        partes = [f"\n=== SLIDE {i} ==="]
+        
+        # Extrair texto de todas as formas no slide
+        for shape in slide.shapes:
+            if shape.has_text_frame:
+                texto = shape.text_frame.text
+                if texto.strip():
+                    partes.append(texto)
+            
+            # Extrair texto de tabelas se houver
+            if shape.has_table:
+                table = shape.table
+                for row in table.rows:
+                    row_text = " | ".join([cell.text.strip() for cell in row.cells])
+                    if row_text.strip():
+                        partes.append(f"Tabela: {row_text}")
+        
+        # Slides sem texto não geram documento
+        if len(partes) == 1:
+            continue
+        
+        # Um único join por slide em vez de concatenações sucessivas
+        documentos.append(Document(
+            text="\n".join(partes) + "\n",
+            metadata={
+                "file_name": nome_arquivo,
+                "file_type": "pptx",
+                "slide": i,
+                "total_slides": len(prs.slides),
+                "source": "presentation"
+            }
+        ))
+    
+    return documentos, len(prs.slides)
+
+def processar_pdf(dados, nome_arquivo):
+    """Processa arquivo PDF com PyMuPDF gerando um Document por página"""
+    documentos = []
+    
+    with fitz.open(stream=dados, filetype="pdf") as pdf:
+        for i, pagina in enumerate(pdf, 1):
+            texto = pagina.get_text("text")
+            
+            # Páginas sem texto não geram documento
+            if not texto.strip():
+                continue
+            
+            documentos.append(Document(
+                text=texto,
+                metadata={
+                    "file_name": nome_arquivo,
+                    "file_type": "pdf",
+                    "page_label": str(i),
+                    "source": "document"
+                }
+            ))
+        
+        return documentos, pdf.page_count
+
+def processar_membro(zip_path, nome):
+    """Processa um PPTX ou PDF lendo o próprio membro do ZIP (executado em um processo do pool)"""
+    # Fora do contexto do Streamlit: erros sobem para o processo principal
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        dados = zip_ref.read(nome)
+    
+    nome_arquivo = os.path.basename(nome)
+    if os.path.splitext(nome)[1].lower() == ".pdf":
+        return processar_pdf(dados, nome_arquivo)
+    return processar_pptx(io.BytesIO(dados), nome_arquivo)